@@ -3,21 +3,17 @@ from commit_by_extension import config as conf
 import pathlib
 import logging
 import os
-from typing import List
-from commit_by_extension.merging import Merger, MergeError
+from typing import List, Optional
+from commit_by_extension.merging import Merger, BatchMerger, MergeError
+from commit_by_extension.journal import Journal, write_marker, has_marker
+from commit_by_extension.conflicts import build_index, excluded_extensions
+from commit_by_extension import log
 from multiprocessing import Process
 
-handlers = [logging.FileHandler('./working.log', encoding='utf-8')]
-logging.basicConfig(
-    level=logging.INFO,
-    handlers=handlers,
-    format='%(levelname)s|%(asctime)s|%(name)s|%(funcName)s|%(message)s',
-    datefmt='%d-%b-%y %H:%M:%S'
-)
 logger = logging.getLogger(__name__)
 
 
-def main(config: conf.Config):
+def main(config: conf.Config, resume: bool = False):
 
     extensions = get_extensions(config.extension_dir)
 
@@ -30,51 +26,252 @@ def main(config: conf.Config):
     tmp_designer, extension_xml_dir = prepare_env(config.temp_dir, config.platform_version)
     main_xml_path = config.base_xml
 
-    p = Process(target=update_main_base_from_repo, args=(designer, main_xml_path))
-    p.start()
-
-    xml_extension_paths = []
+    journal = Journal(config.temp_dir.joinpath('journal.json'), resume)
 
-    logger.info(f'Начало выгрузки расширений в xml')
-    for extension in extensions:
-        tmp_designer.load_extension_from_file(str(extension.absolute().resolve()), extension.name)
-        xml_extension_paths.append(extension_xml_dir.joinpath(extension.name))
-    tmp_designer.dump_extensions_to_files(extension_xml_dir)
-    logger.info(f'Окнончание выгрузки расширений в xml')
+    # Группы независимых расширений для параллельного слияния строятся при поиске конфликтов
+    if config.merge_parallel > 1 and not (config.merge_batch and config.merge_check_conflicts):
+        logger.warning('Параметр [merge] parallel=%s используется только вместе с batch=true и check_conflicts=true '
+                       'и будет проигнорирован', config.merge_parallel)
 
-    p.join()
-    if p.exitcode != 0:
-        raise MergeError('Ошибка выполнения.')
+    extensions = [extension for extension in extensions
+                  if not is_committed(journal, extension, config.temp_dir, resume)]
+    if not extensions:
+        logger.info('Все расширения уже помещены в хранилище.')
+        return
 
-    conf_dump = main_xml_path.joinpath('ConfigDumpInfo.xml')
-    if conf_dump.exists():
-        os.remove(conf_dump)
+    workspace_fresh = not journal.is_done('main_xml', main_xml_path)
 
     p = None
+    if workspace_fresh:
+        p = start_process(update_main_base_from_repo, designer, main_xml_path)
 
-    for xml_extension_path in xml_extension_paths:
-        logger.info(f'Начало слияния расширения {xml_extension_path.stem}')
-        merger = Merger(main_xml_path, xml_extension_path, config.temp_dir)
-        try:
-            merge_settings, object_list, list_files = merger.merge()
-        except MergeError:
-            logger.error(f'При слиянии расширения {xml_extension_path.stem} произошла ошибка {MergeError}, '
-                         f'расширение не будет объединено')
-            continue
+    xml_extension_paths = [extension_xml_dir.joinpath(extension.name) for extension in extensions]
 
+    if not all(journal.is_done(f'{extension.stem}:xml', extension, xml_extension_path)
+               for extension, xml_extension_path in zip(extensions, xml_extension_paths)):
+        logger.info(f'Начало выгрузки расширений в xml')
+        for extension in extensions:
+            tmp_designer.load_extension_from_file(str(extension.absolute().resolve()), extension.name)
+        tmp_designer.dump_extensions_to_files(extension_xml_dir)
+        for extension, xml_extension_path in zip(extensions, xml_extension_paths):
+            journal.mark_done(f'{extension.stem}:xml', extension, xml_extension_path)
+        logger.info(f'Окнончание выгрузки расширений в xml')
+
+    if p is not None:
+        p.join()
+        if p.exitcode != 0:
+            raise MergeError('Ошибка выполнения.')
+        finish_main_xml_update(main_xml_path, journal)
+
+    groups = None
+    if config.merge_check_conflicts:
+        logger.info(f'Поиск конфликтов расширений')
+        index = build_index(main_xml_path, xml_extension_paths)
+        excluded = excluded_extensions(index.conflicts())
+        for name in sorted(excluded):
+            logger.error('Расширение %s исключено из обработки из-за конфликтов', name,
+                         extra={'extension': name, 'stage': 'conflicts'})
+        pending = [(extension, xml_extension_path)
+                   for extension, xml_extension_path in zip(extensions, xml_extension_paths)
+                   if xml_extension_path.stem not in excluded]
+        extensions = [extension for extension, _ in pending]
+        xml_extension_paths = [xml_extension_path for _, xml_extension_path in pending]
+        if not extensions:
+            logger.error('Все расширения исключены из обработки.')
+            return
+        if config.merge_batch and config.merge_parallel > 1:
+            xml_paths_by_name = {xml_extension_path.stem: xml_extension_path
+                                 for xml_extension_path in xml_extension_paths}
+            groups = [[xml_paths_by_name[name] for name in group if name in xml_paths_by_name]
+                      for group in index.groups()]
+            groups = [group for group in groups if group]
+
+    if config.merge_batch:
+        merge_batch(config, designer, tmp_designer, main_xml_path, extensions, xml_extension_paths,
+                    journal, workspace_fresh, groups)
+        return
+
+    p = None
+    committing = None
+    force = workspace_fresh
+
+    for extension, xml_extension_path in zip(extensions, xml_extension_paths):
+        merger = Merger(main_xml_path, xml_extension_path, config.temp_dir,
+                        config.merge_streaming, config.merge_memory_limit)
+        merge_settings, object_list, list_files = merger.merge_settings, merger.object_list, merger.list_files
         cf_path = config.temp_dir.joinpath(f'{xml_extension_path.stem}.cf')
-        logger.info(f'Преобразование объединенной xml выгрузки основной конфигурации и расширения'
-                    f' {xml_extension_path.stem} в cf')
-        convert_xml_to_cf(tmp_designer, main_xml_path, cf_path, list_files)
-        logger.info(f'Преобразование объединенной xml выгрузки {xml_extension_path.stem} завершено')
+
+        merge_stage = f'{xml_extension_path.stem}:merge'
+        cf_stage = f'{xml_extension_path.stem}:cf'
+        extension_log = log.ContextAdapter(logger, {'extension': xml_extension_path.stem})
+
+        merged = merged_extensions(journal)
+        merge_done = not force and journal.is_done(merge_stage, extension, merge_settings, object_list, list_files)
+        cf_done = merge_done and journal.is_done(cf_stage, extension, cf_path)
+
+        # Выгрузка обновляется из хранилища, а незавершенные расширения объединяются заново, если:
+        # - слияние выполнено, но cf отсутствует или изменен, а выгрузка уже содержит слияние следующего расширения
+        #   (например, cf удален после аварийного завершения), повторное преобразование включило бы в cf
+        #   чужие изменения;
+        # - слияние требуется повторить (изменено расширение или результаты слияния), а выгрузка уже содержит
+        #   слияние этого расширения, повторное слияние продублировало бы его изменения.
+        if (merge_done and not cf_done and merged[-1:] != [xml_extension_path.stem]
+                or not merge_done and xml_extension_path.stem in merged):
+            extension_log.info('Выгрузка основной конфигурации не соответствует этапу %s, требуется повторное слияние',
+                               merge_stage if xml_extension_path.stem in merged else cf_stage,
+                               extra={'stage': 'resume'})
+            if p is not None:
+                finish_commit(p, committing, journal)
+                p = None
+            update_main_base_from_repo(designer, main_xml_path)
+            finish_main_xml_update(main_xml_path, journal)
+            merge_done = False
+
+        if not merge_done:
+            force = True
+            extension_log.info('Начало слияния расширения %s', xml_extension_path.stem, extra={'stage': 'merge'})
+            try:
+                merger.merge()
+            except MergeError as ex:
+                extension_log.error('При слиянии расширения %s произошла ошибка %s, расширение не будет объединено',
+                                    xml_extension_path.stem, ex, extra={'stage': 'merge'})
+                merger.rollback()
+                # Выгрузка возвращена в состояние после предыдущего слияния
+                journal.mark_done('main_xml', main_xml_path, data=journal.get_data('main_xml'))
+                continue
+            finally:
+                merger.clear_temp()
+            journal.mark_done(merge_stage, extension, merge_settings, object_list, list_files)
+            journal.mark_done('main_xml', main_xml_path, data=merged_extensions(journal) + [xml_extension_path.stem])
+
+        if not cf_done:
+            extension_log.info('Преобразование объединенной xml выгрузки основной конфигурации и расширения %s в cf',
+                               xml_extension_path.stem, extra={'stage': 'convert'})
+            convert_xml_to_cf(tmp_designer, main_xml_path, cf_path, list_files)
+            journal.mark_done(cf_stage, extension, cf_path)
+            extension_log.info('Преобразование объединенной xml выгрузки %s завершено',
+                               xml_extension_path.stem, extra={'stage': 'convert'})
 
         if p is not None:
-            result = p.join()
-        p = Process(target=make_commit, args=(designer, cf_path, merge_settings, object_list))
-        p.start()
+            finish_commit(p, committing, journal)
+        p = start_process(make_commit, designer, cf_path, merge_settings, object_list, [extension], config.temp_dir)
+        committing = extension
 
     if p is not None:
-        result = p.join()
+        finish_commit(p, committing, journal)
+
+
+def merge_batch(config: conf.Config, designer: api.Designer, tmp_designer: api.Designer,
+                main_xml_path: pathlib.Path, extensions: List[pathlib.Path], xml_extension_paths: List[pathlib.Path],
+                journal: Journal, workspace_fresh: bool = True, groups: Optional[List[List[pathlib.Path]]] = None):
+    logger.info(f'Начало пакетного слияния расширений')
+    merger = BatchMerger(main_xml_path, xml_extension_paths, config.temp_dir,
+                         config.merge_streaming, config.merge_memory_limit, config.merge_parallel, groups)
+    merge_settings, object_list, list_files = merger.merge_settings, merger.object_list, merger.list_files
+    cf_path = config.temp_dir.joinpath('batch.cf')
+
+    merge_done = (not workspace_fresh
+                  and merged_extensions(journal)
+                  and merged_extensions(journal) == journal.get_data('batch:merge')
+                  and journal.is_done('batch:merge', *extensions, merge_settings, object_list, list_files))
+
+    if merge_done:
+        merged_names = journal.get_data('batch:merge')
+    else:
+        if merged_extensions(journal):
+            # Выгрузка содержит предыдущее слияние, повторное слияние продублировало бы изменения расширений
+            logger.info('Выгрузка основной конфигурации уже содержит слияние расширений %s, '
+                        'требуется обновление из хранилища', ', '.join(merged_extensions(journal)),
+                        extra={'stage': 'resume'})
+            update_main_base_from_repo(designer, main_xml_path)
+            finish_main_xml_update(main_xml_path, journal)
+        merger.merge()
+
+        for xml_extension_path in merger.failed:
+            logger.error('Расширение %s исключено из пакета', xml_extension_path.stem,
+                         extra={'extension': xml_extension_path.stem, 'stage': 'merge'})
+
+        merged_names = [xml_extension_path.stem for xml_extension_path in merger.merged]
+        journal.mark_done('batch:merge', *extensions, merge_settings, object_list, list_files, data=merged_names)
+        journal.mark_done('main_xml', main_xml_path, data=merged_names)
+
+    if not merged_names:
+        logger.error('Ни одно расширение не объединено, помещение в хранилище не выполняется.')
+        return
+
+    if not (merge_done and journal.is_done('batch:cf', *extensions, cf_path)):
+        logger.info('Преобразование объединенной xml выгрузки основной конфигурации и расширений %s в cf',
+                    ', '.join(merged_names), extra={'stage': 'convert'})
+        convert_xml_to_cf(tmp_designer, main_xml_path, cf_path, list_files)
+        journal.mark_done('batch:cf', *extensions, cf_path)
+        logger.info(f'Преобразование объединенной xml выгрузки завершено')
+
+    make_commit(designer, cf_path, merge_settings, object_list,
+                [extension for extension in extensions if extension.stem in merged_names], config.temp_dir,
+                f'Слияние c расширениями {", ".join(merged_names)}')
+
+    for extension in extensions:
+        if extension.stem in merged_names:
+            journal.mark_done(f'{extension.stem}:commit', extension)
+
+
+def merged_extensions(journal: Journal) -> List[str]:
+    """
+    Расширения, объединенные с текущей выгрузкой основной конфигурации, в порядке слияния
+    :param journal:
+    :return:
+    """
+    return journal.get_data('main_xml') or []
+
+
+def finish_main_xml_update(main_xml_path: pathlib.Path, journal: Journal):
+    conf_dump = main_xml_path.joinpath('ConfigDumpInfo.xml')
+    if conf_dump.exists():
+        os.remove(conf_dump)
+    journal.mark_done('main_xml', main_xml_path)
+
+
+def commit_marker(temp_dir: pathlib.Path, extension: pathlib.Path) -> pathlib.Path:
+    return temp_dir.joinpath(f'{extension.stem}.committed')
+
+
+def is_committed(journal: Journal, extension: pathlib.Path, temp_dir: pathlib.Path, resume: bool) -> bool:
+    """
+    Расширение помещено в хранилище: этап отмечен в журнале или процесс помещения успел записать отметку,
+    а основной процесс завершился до ее переноса в журнал
+    :param journal:
+    :param extension:
+    :param temp_dir:
+    :param resume: отметки процессов помещения учитываются только при продолжении обработки
+    :return:
+    """
+    stage = f'{extension.stem}:commit'
+    if journal.is_done(stage, extension):
+        return True
+    if not (resume and has_marker(commit_marker(temp_dir, extension), extension)):
+        return False
+    logger.info('Расширение %s уже помещено в хранилище, пропуск', extension.stem,
+                extra={'extension': extension.stem, 'stage': 'resume'})
+    journal.mark_done(stage, extension)
+    return True
+
+
+def finish_commit(p: Process, extension: pathlib.Path, journal: Journal):
+    p.join()
+    if p.exitcode != 0:
+        logger.error('Ошибка помещения в хранилище расширения %s', extension.stem,
+                     extra={'extension': extension.stem, 'stage': 'commit'})
+        return
+    journal.mark_done(f'{extension.stem}:commit', extension)
+
+
+def start_process(target, *args) -> Process:
+    """
+    Запускает процесс, журнал которого передается в общую очередь журнала основного процесса
+    """
+    p = Process(target=log.run_in_worker, args=(log.get_worker_queue(), logging.getLogger().level, target) + args)
+    p.start()
+    return p
 
 
 def update_main_base_from_repo(designer: api.Designer, main_xml_path: pathlib.Path):
@@ -90,11 +287,20 @@ def convert_xml_to_cf(designer, xml_path: pathlib.Path, cf_path: pathlib.Path, l
     designer.dump_config_to_file(str(cf_path))
 
 
-def make_commit(designer: api.Designer, cf_path: pathlib.Path, merge_settings: pathlib.Path, object_list: pathlib.Path):
+def make_commit(designer: api.Designer, cf_path: pathlib.Path, merge_settings: pathlib.Path, object_list: pathlib.Path,
+                extensions: List[pathlib.Path], temp_dir: pathlib.Path, comment: str = ''):
+    """
+    Помещает объединенную конфигурацию в хранилище и записывает отметки о помещении расширений,
+    см. is_committed
+    """
+    if not comment:
+        comment = f'Слияние c расширением {cf_path.name}'
     logger.info(f'Начало отправки изменений в хранлище')
     designer.lock_objects_in_repository(str(object_list))
     designer.merge_config_with_file(str(cf_path), str(merge_settings))
-    designer.commit_config_to_repo(f'Слияние c расширением {cf_path.name}', str(object_list))
+    designer.commit_config_to_repo(comment, str(object_list))
+    for extension in extensions:
+        write_marker(commit_marker(temp_dir, extension), extension)
     designer.unlock_objects_in_repository(str(object_list))
     logger.info(f'Изменения помещены в хранилище')
 
@@ -120,7 +326,7 @@ def prepare_env(temp_dir_path: str, v8_version: str) -> (api.Designer, pathlib.P
 
 
 def get_extensions(path: str) -> List[pathlib.Path]:
-    logger.info(f'Поиск расширений в папке {path}')
+    logger.info('Поиск расширений в папке %s', path)
     res = []
 
     ext_dir = pathlib.Path(path)
@@ -130,7 +336,7 @@ def get_extensions(path: str) -> List[pathlib.Path]:
 
     for element in ext_dir.iterdir():
         if element.is_file() and element.suffix == '.cfe':
-            logger.debug(f'Добавление расширения из файла {element} в обработку')
+            logger.debug('Добавление расширения из файла %s в обработку', element)
             res.append(element)
 
     return res
@@ -140,13 +346,12 @@ def create_designer(config: conf.Config) -> api.Designer:
     repo_connection = api.RepositoryConnection(config.repo_path, config.repo_user, config.repo_password)
     conn = None
     if config.base_server != '':
-        logger.debug(f'Формирование подключения к БД с параметрами: '
-                     f'server_path:{config.base_server} server_base_ref:{config.base_ref}')
+        logger.debug('Формирование подключения к БД с параметрами: server_path:%s server_base_ref:%s',
+                     config.base_server, config.base_ref)
         conn = api.Connection(
             config.base_user, config.base_password, server_path=config.base_server, server_base_ref=config.base_ref)
     elif config.base_path != '':
-        logger.debug(f'Формирование подключения к БД с параметрами: '
-                     f'file_path:{config.base_path}')
+        logger.debug('Формирование подключения к БД с параметрами: file_path:%s', config.base_path)
         conn = api.Connection(
             config.base_user, config.base_password, file_path=config.base_path)
 
@@ -154,6 +359,6 @@ def create_designer(config: conf.Config) -> api.Designer:
         logger.error('Не удалось определить парметры подключения к БД!')
         raise ValueError('Не удалось определить парметры подключения к БД')
 
-    logger.info(f'Создание конфигуратора с прааметрами base: {conn} repo: {repo_connection}')
+    logger.info('Создание конфигуратора с прааметрами base: %s repo: %s', conn, repo_connection)
 
     return api.Designer(config.platform_version, connection=conn, repo_connection=repo_connection)
@@ -23,6 +23,18 @@ class Config:
 
         self.platform_version = conf_parser.get('1c', 'version')
 
+        self.merge_streaming = conf_parser.getboolean('merge', 'streaming', fallback=False)
+        self.merge_memory_limit = conf_parser.getint('merge', 'memory_limit', fallback=0)
+        if self.merge_memory_limit and not self.merge_streaming:
+            raise ValueError('Параметр [merge] memory_limit задается только вместе с streaming=true')
+        self.merge_batch = conf_parser.getboolean('merge', 'batch', fallback=False)
+        self.merge_check_conflicts = conf_parser.getboolean('merge', 'check_conflicts', fallback=True)
+        self.merge_parallel = conf_parser.getint('merge', 'parallel', fallback=1)
+
+        self.log_file = conf_parser.get('log', 'file', fallback='./working.log')
+        self.log_level = conf_parser.get('log', 'level', fallback='INFO').upper()
+        self.log_format = conf_parser.get('log', 'format', raw=True, fallback=None)
+
 
 def get_config(conf_file: typing.Optional[pathlib.Path] = None):
 
@@ -0,0 +1,165 @@
+import pathlib
+import logging
+from typing import Dict, List, Set, Tuple, NamedTuple, Optional
+import mdclasses
+from commit_by_extension.merging import get_obj_module, release_obj_modules
+
+
+logger = logging.getLogger(__name__)
+
+CONFIGURATION_DESCRIPTION = 'Configuration.xml'
+
+# Режимы, добавляющие вызов в подпрограмму. Остальные режимы заменяют тело подпрограммы, см. Merger.merge_union
+APPENDING_MODIFIERS = ('Перед'.upper(), 'После'.upper())
+
+
+class Hook(NamedTuple):
+    extension: str
+    modifier_type: str
+
+
+class Conflict(NamedTuple):
+    obj_name: str
+    module: str
+    sub_program: str
+    extensions: Tuple[str, ...]
+    reason: str
+
+
+class ConflictIndex:
+    """
+    Индекс расширяемых подпрограмм основной конфигурации:
+    (объект, модуль, подпрограмма) -> расширения и типы расширения.
+    Позволяет до начала слияния найти конфликты и группы независимых расширений.
+    """
+
+    def __init__(self, cf_xml_path: pathlib.Path):
+        self._cf_xml_path = cf_xml_path
+        self._main_conf: Optional[mdclasses.Configuration] = None
+
+        self.hooks: Dict[Tuple[str, str, str], List[Hook]] = {}
+        self.resources: Dict[str, Set[str]] = {}
+        self.missing: List[Conflict] = []
+
+    def read_data(self):
+        if self._main_conf is None:
+            self._main_conf = mdclasses.read_configuration(str(self._cf_xml_path))
+
+    def add_extension(self, cfe_xml_path: pathlib.Path):
+        """
+        Добавляет в индекс подпрограммы и файлы основной конфигурации, изменяемые расширением
+        :param cfe_xml_path:
+        :return:
+        """
+        self.read_data()
+        extension_name = cfe_xml_path.stem
+        extension = mdclasses.read_configuration(str(cfe_xml_path))
+        resources = self.resources.setdefault(extension_name, set())
+
+        for obj in extension.conf_objects:
+            if obj.obj_type == mdclasses.ObjectType.LANGUAGE:
+                continue
+            try:
+                main_obj = self._main_conf.get_object(obj.name, obj.obj_type)
+            except IndexError:
+                if obj.obj_type != mdclasses.ObjectType.ROLE:
+                    resources.add(CONFIGURATION_DESCRIPTION)
+                    resources.add(obj.full_name)
+                continue
+
+            main_modules = get_obj_module(main_obj)
+            for module in get_obj_module(obj):
+                module_name = str(pathlib.Path(module.file_name).relative_to(extension.root_path))
+                # Модули объекта лежат в общем каталоге Ext, который Merger создает и удаляет при откате целиком,
+                # поэтому общим ресурсом считается объект, а не файл модуля
+                resources.add(obj.full_name)
+                main_module = next(filter(lambda m: module.match(m), main_modules), None)
+
+                for sub_program in list(module.procedures()) + list(module.functions()):
+                    if sub_program.expansion_modifier is None:
+                        continue
+                    sub_program_name = sub_program.expansion_modifier.sub_program_name
+                    key = (obj.full_name, module_name, sub_program_name.upper())
+                    self.hooks.setdefault(key, []).append(
+                        Hook(extension_name, sub_program.expansion_modifier.modifier_type))
+
+                    if main_module is None:
+                        continue
+                    try:
+                        main_module.find_sub_program(sub_program_name)
+                    except KeyError:
+                        self.missing.append(Conflict(obj.full_name, module_name, sub_program_name,
+                                                     (extension_name,), 'подпрограмма не найдена в основной конфигурации'))
+
+            release_obj_modules(main_obj)
+            release_obj_modules(obj)
+
+    def conflicts(self) -> List[Conflict]:
+        """
+        Конфликты: расширяемая подпрограмма отсутствует в основной конфигурации
+        или подпрограмму, заменяемую одним из расширений (режимы кроме Перед и После),
+        расширяет более одного расширения.
+        :return:
+        """
+        result = list(self.missing)
+        for (obj_name, module_name, sub_program_name), hooks in self.hooks.items():
+            extensions = tuple(dict.fromkeys(hook.extension for hook in hooks))
+            if len(extensions) < 2:
+                continue
+            replacing = [hook.modifier_type for hook in hooks if hook.modifier_type.upper() not in APPENDING_MODIFIERS]
+            if replacing:
+                result.append(Conflict(obj_name, module_name, sub_program_name, extensions,
+                                       f'подпрограмма заменяется расширением ({", ".join(replacing)}) '
+                                       f'и расширяется несколькими расширениями'))
+        return result
+
+    def groups(self) -> List[List[str]]:
+        """
+        Группы расширений, изменяющих модули одних и тех же объектов или описание конфигурации.
+        Расширения разных групп можно объединять одновременно.
+        :return:
+        """
+        parents = {name: name for name in self.resources}
+
+        def find(name: str) -> str:
+            while parents[name] != name:
+                parents[name] = parents[parents[name]]
+                name = parents[name]
+            return name
+
+        owners = {}
+        for name in sorted(self.resources):
+            for resource in self.resources[name]:
+                owner = owners.setdefault(resource, name)
+                parents[find(name)] = find(owner)
+
+        groups = {}
+        for name in sorted(self.resources):
+            groups.setdefault(find(name), []).append(name)
+        return list(groups.values())
+
+
+def build_index(cf_xml_path: pathlib.Path, cfe_xml_paths: List[pathlib.Path]) -> ConflictIndex:
+    index = ConflictIndex(cf_xml_path)
+    for cfe_xml_path in sorted(cfe_xml_paths, key=lambda p: p.name):
+        index.add_extension(cfe_xml_path)
+    return index
+
+
+def excluded_extensions(conflicts: List[Conflict]) -> Set[str]:
+    """
+    Расширения, которые нельзя объединять: расширения с отсутствующими подпрограммами
+    и все кроме первого расширения, заменяющего одну и ту же подпрограмму.
+    :param conflicts:
+    :return:
+    """
+    excluded = set()
+    for conflict in conflicts:
+        logger.error('Конфликт расширений %s: %s, подпрограмма %s', ', '.join(conflict.extensions), conflict.reason,
+                     conflict.sub_program,
+                     extra={'object': conflict.obj_name, 'module_name': conflict.module, 'stage': 'conflicts'})
+        if len(conflict.extensions) == 1:
+            excluded.update(conflict.extensions)
+        else:
+            excluded.update(conflict.extensions[1:])
+    return excluded
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+from typing import Union, Optional, Any
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    """
+    Журнал выполненных этапов обработки расширений.
+    Для каждого этапа хранится хеш его результатов, этап считается выполненным,
+    только если результаты не изменились с момента записи.
+    """
+
+    def __init__(self, path: pathlib.Path, resume: bool = False):
+        self.path = path
+        self._entries = {}
+        if resume:
+            self._entries = self.read()
+
+    def read(self) -> dict:
+        if not self.path.exists():
+            logger.info('Журнал этапов %s не обнаружен, обработка начнется сначала', self.path,
+                        extra={'stage': 'resume'})
+            return {}
+        try:
+            data = json.loads(self.path.read_text(encoding='utf-8'))
+            entries = data['entries']
+            checksum = data['checksum']
+        except (ValueError, KeyError, TypeError):
+            logger.error('Журнал этапов %s поврежден, обработка начнется сначала', self.path,
+                         extra={'stage': 'resume'})
+            return {}
+        if checksum != entries_checksum(entries):
+            logger.error('Не совпадает контрольная сумма журнала этапов %s, обработка начнется сначала', self.path,
+                         extra={'stage': 'resume'})
+            return {}
+        return entries
+
+    def save(self):
+        """
+        Записывает журнал через временный файл, чтобы при аварийном завершении не получить поврежденный журнал
+        :return:
+        """
+        data = {'entries': self._entries, 'checksum': entries_checksum(self._entries)}
+        tmp_path = self.path.with_name(f'{self.path.name}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def is_done(self, stage: str, *artifacts: Union[str, pathlib.Path]) -> bool:
+        entry = self._entries.get(stage)
+        if entry is None:
+            return False
+        if entry['hash'] != artifacts_hash(artifacts):
+            logger.info('Результаты этапа %s изменились, этап будет выполнен повторно', stage, extra={'stage': stage})
+            return False
+        logger.info('Этап %s уже выполнен, пропуск', stage, extra={'stage': stage})
+        return True
+
+    def mark_done(self, stage: str, *artifacts: Union[str, pathlib.Path], data: Any = None):
+        self._entries[stage] = {'hash': artifacts_hash(artifacts), 'data': data}
+        self.save()
+
+    def get_data(self, stage: str) -> Optional[Any]:
+        entry = self._entries.get(stage)
+        if entry is None:
+            return None
+        return entry['data']
+
+
+def write_marker(path: pathlib.Path, *artifacts: Union[str, pathlib.Path]):
+    """
+    Записывает отметку о выполнении этапа в отдельный файл.
+    Используется дочерними процессами, которые не могут записывать журнал основного процесса.
+    :param path:
+    :param artifacts: результаты этапа, см. artifacts_hash
+    :return:
+    """
+    tmp_path = path.with_name(f'{path.name}.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(artifacts_hash(artifacts))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def has_marker(path: pathlib.Path, *artifacts: Union[str, pathlib.Path]) -> bool:
+    return path.exists() and path.read_text(encoding='utf-8') == artifacts_hash(artifacts)
+
+
+def entries_checksum(entries: dict) -> str:
+    return hashlib.sha256(json.dumps(entries, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def artifacts_hash(artifacts) -> str:
+    """
+    Хеш результатов этапа. Файлы хешируются по содержимому,
+    каталоги по составу файлов, их размеру и времени изменения.
+    :param artifacts:
+    :return:
+    """
+    digest = hashlib.sha256()
+    for artifact in artifacts:
+        path = pathlib.Path(artifact)
+        digest.update(str(path).encode('utf-8'))
+        if path.is_file():
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+        elif path.is_dir():
+            for file_path in sorted(path.rglob('*')):
+                if not file_path.is_file():
+                    continue
+                stat = file_path.stat()
+                digest.update(f'{file_path.relative_to(path)}|{stat.st_size}|{stat.st_mtime_ns}'.encode('utf-8'))
+        else:
+            digest.update(b'<missing>')
+    return digest.hexdigest()
@@ -0,0 +1,127 @@
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+from typing import Optional, List
+
+FIELDS = ('extension', 'object', 'module_name', 'stage')
+
+DEFAULT_FORMAT = '%(levelname)s|%(asctime)s|%(name)s|%(funcName)s|' \
+                 '%(extension)s|%(object)s|%(module_name)s|%(stage)s|%(message)s'
+DATE_FORMAT = '%d-%b-%y %H:%M:%S'
+
+_listeners: List[logging.handlers.QueueListener] = []
+_handler: Optional[logging.Handler] = None
+_local_handler: Optional[logging.Handler] = None
+_worker_queue: Optional[multiprocessing.Queue] = None
+
+
+class ContextFilter(logging.Filter):
+    """
+    Заполняет отсутствующие структурные поля записи, чтобы формат не зависел от места вызова
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for field in FIELDS:
+            if not hasattr(record, field):
+                setattr(record, field, '-')
+        return True
+
+
+class ContextAdapter(logging.LoggerAdapter):
+    """
+    Добавляет к записям структурные поля, поля из extra вызова дополняют поля адаптера
+    """
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = {**self.extra, **kwargs.get('extra', {})}
+        return msg, kwargs
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """
+    Передает записи в поток записи журнала без форматирования, сообщение формируется уже в потоке записи
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(file_name: Optional[str] = None, level: str = 'INFO', fmt: Optional[str] = None):
+    """
+    Настраивает запись журнала в фоновом потоке.
+    Записи основного процесса передаются через очередь без форматирования,
+    записи дочерних процессов через общую очередь multiprocessing, см. configure_worker.
+    :param file_name: файл журнала, если не указан - вывод в stderr
+    :param level:
+    :param fmt:
+    :return:
+    """
+    global _handler, _local_handler, _worker_queue
+
+    stop_logging()
+
+    if file_name:
+        _handler = logging.FileHandler(file_name, encoding='utf-8')
+    else:
+        _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter(fmt or DEFAULT_FORMAT, DATE_FORMAT))
+    _handler.addFilter(ContextFilter())
+
+    local_queue = queue.SimpleQueue()
+    _worker_queue = multiprocessing.Queue()
+
+    _listeners.extend([
+        logging.handlers.QueueListener(local_queue, _handler),
+        logging.handlers.QueueListener(_worker_queue, _handler),
+    ])
+    for listener in _listeners:
+        listener.start()
+
+    _local_handler = LocalQueueHandler(local_queue)
+    root = logging.getLogger()
+    root.handlers = [_local_handler]
+    root.setLevel(level)
+
+
+def stop_logging():
+    """
+    Дожидается записи всех сообщений из очередей и закрывает журнал
+    :return:
+    """
+    global _handler, _local_handler, _worker_queue
+
+    if _local_handler is not None:
+        logging.getLogger().removeHandler(_local_handler)
+        _local_handler = None
+
+    while _listeners:
+        _listeners.pop().stop()
+
+    if _handler is not None:
+        _handler.close()
+        _handler = None
+    _worker_queue = None
+
+
+def get_worker_queue() -> Optional[multiprocessing.Queue]:
+    return _worker_queue
+
+
+def configure_worker(worker_queue: Optional[multiprocessing.Queue], level: int = logging.INFO):
+    """
+    Направляет журнал дочернего процесса в очередь основного процесса
+    :param worker_queue: очередь из get_worker_queue, если None - настройки журнала не меняются
+    :param level:
+    :return:
+    """
+    if worker_queue is None:
+        return
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(worker_queue)]
+    root.setLevel(level)
+
+
+def run_in_worker(worker_queue: Optional[multiprocessing.Queue], level: int, target, *args):
+    configure_worker(worker_queue, level)
+    target(*args)
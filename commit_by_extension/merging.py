@@ -1,30 +1,56 @@
 import pathlib
 import mdclasses
-from typing import Optional, Union
-from commit_by_extension.utils import clear_folder
+from typing import Optional, Union, NamedTuple, List, Dict, Iterable
+from commit_by_extension.utils import clear_folder, get_memory_usage
+from commit_by_extension import log
 import shutil
 from lxml import etree
 import re
+import os
 import logging
+from multiprocessing import Pool
 
 
 logger = logging.getLogger(__name__)
 
+_memory_warning_logged = False
+
 
 class MergeError(Exception):
     pass
 
 
+class ObjectRecord(NamedTuple):
+    """
+    Облегченное описание объединенного объекта для формирования настроек.
+    full_name равен None для самой конфигурации.
+    """
+    full_name: Optional[str]
+    is_new: bool = False
+
+
 class Merger:
 
     def __init__(self, cf_xml_path: pathlib.Path,
                  cfe_xml_path: pathlib.Path,
-                 temp_dir: pathlib.Path):
+                 temp_dir: pathlib.Path,
+                 streaming: bool = False,
+                 memory_limit: int = 0):
+        """
+        :param streaming: освобождать модули и формы объектов сразу после их обработки.
+            Описания объектов конфигурации и расширения остаются в памяти до окончания слияния.
+        :param memory_limit: предел потребляемой памяти в МБ для потокового режима, 0 - без ограничения.
+            Проверяется после обработки каждого объекта расширения и после формирования настроек,
+            поиск конфликтов (conflicts.ConflictIndex) предел не контролирует.
+        """
+        if memory_limit and not streaming:
+            raise ValueError('Предел памяти memory_limit задается только для потокового режима слияния')
 
         self._cfe_xml_path = cfe_xml_path
         self._cf_xml_path = cf_xml_path
 
         self._extension_name = self._cfe_xml_path.stem
+        self._logger = log.ContextAdapter(logger, {'extension': self._extension_name, 'stage': 'merge'})
 
         self._temp_dir = temp_dir.joinpath(self._extension_name)
         if not self._temp_dir.exists():
@@ -38,6 +64,12 @@ class Merger:
         self._objects = []
         self._new_objects = []
 
+        self._backups: Dict[pathlib.Path, Optional[pathlib.Path]] = {}
+
+        self.streaming = streaming
+        self.memory_limit = memory_limit
+        self.peak_memory: Optional[int] = None
+
         self.version = '1.2'
         self.platform_version = '8.3.11'
 
@@ -66,22 +98,94 @@ class Merger:
                         add_object_to_conf(self._main_conf, obj)
                         self.add_object_to_confs(obj, True)
                         self.add_object_to_confs(self._main_conf)
+                    if self.streaming:
+                        self.check_memory()
                     continue
 
                 self.merge_objects(main_obj, obj)
                 self.add_object_to_confs(main_obj)
 
+                if self.streaming:
+                    release_obj_modules(main_obj)
+                    release_obj_modules(obj)
+                    self.check_memory()
+
         except NotImplementedError as ex:
             raise MergeError(f'Ошибка объединения модулей {ex.args[0]}')
         except Exception as ex:
-            logger.error(f'Ошибка слияния конфигураций {self._main_conf} {self._extension}')
+            self._logger.error('Ошибка слияния конфигурации %s с расширением %s', self._cf_xml_path, self._cfe_xml_path)
             raise ex
         self.generate_settings()
+        if self.streaming:
+            self.check_memory()
+        if self.streaming and self.peak_memory is not None:
+            self._logger.info('Слияние расширения %s завершено, пиковое потребление памяти %s МБ',
+                              self._extension_name, self.peak_memory)
+        elif self.streaming:
+            self._logger.info('Слияние расширения %s завершено, потребление памяти определить не удалось',
+                              self._extension_name)
         return self.merge_settings, self.object_list, self.list_files
 
+    def check_memory(self):
+        """
+        Фиксирует текущее потребление памяти и проверяет предел memory_limit
+        :return:
+        """
+        global _memory_warning_logged
+
+        usage = get_memory_usage()
+        if usage is None:
+            if self.memory_limit and not _memory_warning_logged:
+                _memory_warning_logged = True
+                self._logger.warning('Не удалось определить потребление памяти процессом, '
+                                     'предел памяти %s МБ не контролируется', self.memory_limit)
+            return
+        self.peak_memory = usage if self.peak_memory is None else max(self.peak_memory, usage)
+        if self.memory_limit and usage > self.memory_limit:
+            raise MergeError(f'Превышен предел памяти при слиянии расширения {self._extension_name}: '
+                             f'{usage} МБ из {self.memory_limit} МБ')
+
+    @property
+    def objects(self) -> List[ObjectRecord]:
+        return list(self._objects)
+
+    @property
+    def files(self) -> List[str]:
+        return list(self._files)
+
     def add_file_to_list(self, file_name: str):
         self._files.append(file_name)
 
+    def backup_path(self, path: Union[str, pathlib.Path]):
+        """
+        Сохраняет состояние файла основной конфигурации перед изменением для возможности отката
+        :param path:
+        :return:
+        """
+        path = pathlib.Path(path)
+        if path in self._backups:
+            return
+        if path.is_file():
+            backup = self._temp_dir.joinpath(f'{len(self._backups)}{path.suffix}')
+            shutil.copyfile(path, backup)
+            self._backups[path] = backup
+        elif not path.exists():
+            self._backups[path] = None
+
+    def rollback(self):
+        """
+        Возвращает выгрузку основной конфигурации в состояние до слияния
+        :return:
+        """
+        for path, backup in reversed(list(self._backups.items())):
+            if backup is not None:
+                shutil.copyfile(backup, path)
+            elif path.is_dir():
+                shutil.rmtree(path)
+            elif path.exists():
+                path.unlink()
+        self._backups.clear()
+
     def merge_objects(self, main_obj: mdclasses.ConfObject, obj: mdclasses.ConfObject):
 
         try:
@@ -95,17 +199,18 @@ class Merger:
                         main_modules
                     ))
                     self.merge_module(main_module, module)
+                    self.backup_path(main_module.file_name)
                     main_module.save_to_file()
                 except StopIteration:
                     self.add_module(main_obj, module)
         except Exception as ex:
-            logger.error(f'Ошибка слияния объектов {main_obj} {obj}')
+            self._logger.error('Ошибка слияния объекта %s', main_obj.full_name, extra={'object': main_obj.full_name})
             raise ex
 
     def generate_settings(self):
         self.generate_xml_merge_setting()
         self.generate_xml_object_list()
-        self.list_files.write_text('\n'.join([str(file_name) for file_name in self._files]), encoding='utf-8')
+        write_list_files(self._files, self.list_files, self._cf_xml_path)
         self.add_new_objects_to_cf_description()
 
     def add_object_to_confs(self, obj: mdclasses.ConfObject, new_object: bool = False):
@@ -115,12 +220,15 @@ class Merger:
         :param obj:
         :return:
         """
-        self._objects.append(obj)
+        if isinstance(obj, mdclasses.Configuration):
+            self._objects.append(ObjectRecord(None))
+            return
+        self._objects.append(ObjectRecord(obj.full_name, new_object))
         if new_object:
             self.add_new_object(obj)
 
     def add_new_object(self, obj: mdclasses.ConfObject):
-        self._new_objects.append(obj)
+        self._new_objects.append((str(obj.obj_type.value), obj.name))
 
         type_dir_name = pathlib.Path(obj.file_name).parent.name
 
@@ -128,16 +236,19 @@ class Merger:
         extension_type_path = pathlib.Path(self._extension.root_path).joinpath(type_dir_name)
 
         if not type_path.exists():
+            self.backup_path(type_path)
             type_path.mkdir()
 
         new_path = type_path.joinpath(f'{obj.name}.xml')
 
+        self.backup_path(new_path)
         shutil.copy(obj.file_name, new_path)
 
         new_path = type_path.joinpath(obj.name)
         cur_path = extension_type_path.joinpath(obj.name)
 
         if cur_path.exists() and not new_path.exists():
+            self.backup_path(new_path)
             shutil.copytree(cur_path, new_path)
 
     def add_new_objects_to_cf_description(self):
@@ -147,102 +258,23 @@ class Merger:
         desc_path = pathlib.Path(self._main_conf.root_path).joinpath('Configuration.xml')
         desc_xml = etree.fromstring(desc_path.read_bytes())
         child_objects = desc_xml.find('./Configuration/ChildObjects', namespaces=desc_xml.nsmap)
-        for obj in self._new_objects:
-            child = etree.Element(str(obj.obj_type.value))
-            child.text = obj.name
+        for obj_type, name in self._new_objects:
+            child = etree.Element(obj_type)
+            child.text = name
             child_objects.append(child)
-        desc_path.write_bytes(
+        self.backup_path(desc_path)
+        # Запись через временный файл, т.к. описание может одновременно читаться при параллельном слиянии
+        tmp_path = desc_path.with_name(f'{desc_path.name}.{self._extension_name}.tmp')
+        tmp_path.write_bytes(
             etree.tostring(desc_xml, xml_declaration=True, encoding=encoding)
         )
+        os.replace(tmp_path, desc_path)
 
     def generate_xml_merge_setting(self):
-        element = etree.Element(
-            'Settings',
-            attrib={
-                "version": self.version,
-                "platformVersion": str(self.platform_version)
-            },
-            nsmap={
-                None: "http://v8.1c.ru/8.3/config/merge/settings",
-                "xs": "http://www.w3.org/2001/XMLSchema",
-                "xsi": "http://www.w3.org/2001/XMLSchema-instance",
-            }
-        )
-        e_params = etree.Element('Parameters')
-
-        e_param = etree.Element('ConfigurationsRelation')
-        e_param.text = 'SecondConfigurationIsDescendantOfMainConfiguration'
-        e_params.append(e_param)
-
-        e_param = etree.Element('AllowMainConfigurationObjectDeletion')
-        e_param.text = 'true'
-        e_params.append(e_param)
-
-        e_param = etree.Element('CopyObjectsMode')
-        e_param.text = 'false'
-        e_params.append(e_param)
-
-        element.append(e_params)
-
-        e_objects = etree.Element('Objects')
-
-        for obj in self._objects:
-            if isinstance(obj, mdclasses.Configuration):
-                continue
-            attr_name = 'fullName'
-            if obj in self._new_objects:
-                attr_name = 'fullNameInSecondConfiguration'
-            object = etree.Element(
-                'Object',
-                attrib={
-                    attr_name: obj.full_name
-                }
-            )
-            merge_rule = etree.Element('MergeRule')
-            merge_rule.text = 'GetFromSecondConfiguration'
-            object.append(
-                merge_rule
-            )
-            e_objects.append(object)
-
-        element.append(e_objects)
-        self.merge_settings.write_bytes(
-            etree.tostring(element, xml_declaration=True, encoding='utf-8')
-        )
+        write_merge_settings(self._objects, self.merge_settings, self.version, self.platform_version)
 
     def generate_xml_object_list(self):
-        element = etree.Element(
-            'Objects',
-            attrib={
-                "version": '1.0',
-            },
-            nsmap={
-                None: "http://v8.1c.ru/8.3/config/objects"
-            }
-        )
-        conf_add = False
-        for obj in self._objects:
-            if isinstance(obj, mdclasses.Configuration):
-                if conf_add:
-                    continue
-                conf_add = True
-                xml_object = etree.Element(
-                    'Configuration',
-                    attrib={
-                       'includeChildObjects': 'false'
-                    }
-                )
-            else:
-                xml_object = etree.Element('Object',
-                    attrib={
-                        'fullName': obj.full_name,
-                        'includeChildObjects': 'true'}
-                )
-            element.append(xml_object)
-
-        self.object_list.write_bytes(
-            etree.tostring(element, xml_declaration=False, encoding='utf-8')
-        )
+        write_object_list(self._objects, self.object_list)
 
     def merge_module(self, receiver: mdclasses.Module, source: mdclasses.Module):
         for proc in source.procedures():
@@ -251,9 +283,10 @@ class Merger:
             try:
                 main_proc = receiver.find_sub_program(proc.expansion_modifier.sub_program_name)
             except KeyError as ex:
-                logger.error(f'Ошибка слияния модулей, в основном модуле {receiver} из файла {receiver.file_name} '
-                             f'не обнаружена подпрограмма {proc.expansion_modifier.sub_program_name} '
-                             f'указаннная в расширении {source} как расширяемая.')
+                self._logger.error('Ошибка слияния модулей, в основном модуле из файла %s не обнаружена подпрограмма %s '
+                                   'указаннная в расширении как расширяемая.',
+                                   receiver.file_name, proc.expansion_modifier.sub_program_name,
+                                   extra={'module_name': receiver.file_name})
                 raise ex
 
             self.merge_procedure(main_proc, proc)
@@ -264,9 +297,10 @@ class Merger:
             try:
                 main_func = receiver.find_sub_program(func.expansion_modifier.sub_program_name)
             except KeyError as ex:
-                logger.error(f'Ошибка слияния модулей, в основном модуле {receiver} из файла {receiver.file_name} '
-                             f'не обнаружена подпрограмма {func.expansion_modifier.sub_program_name} '
-                             f'указаннная в расширении {source} как расширяемая.')
+                self._logger.error('Ошибка слияния модулей, в основном модуле из файла %s не обнаружена подпрограмма %s '
+                                   'указаннная в расширении как расширяемая.',
+                                   receiver.file_name, func.expansion_modifier.sub_program_name,
+                                   extra={'module_name': receiver.file_name})
                 raise ex
 
             self.merge_procedure(main_func, func)
@@ -276,6 +310,7 @@ class Merger:
             f'\n#Область ИмпортИзРасширения_{self._extension_name}',
             source.module_main_text
         )
+        self.add_file_to_list(str(receiver.file_name))
 
         if source.module_variables_text == '':
             return
@@ -288,8 +323,6 @@ class Merger:
             0
         )
 
-        self.add_file_to_list(str(source.file_name))
-
     def merge_procedure(self, resiver: mdclasses.Procedure, sourse: mdclasses.Procedure):
         modifier_type = sourse.expansion_modifier.modifier_type
         sourse.expansion_modifier = None
@@ -347,7 +380,9 @@ class Merger:
         :return:
         """
         if not obj.ext_path.exists():
+            self.backup_path(obj.ext_path)
             obj.ext_path.mkdir()
+        self.backup_path(obj.ext_path.joinpath(module.file_name.name))
         shutil.copyfile(module.file_name, obj.ext_path.joinpath(module.file_name.name))
         self.add_file_to_list(str(obj.ext_path.joinpath(module.file_name.name)))
 
@@ -356,6 +391,130 @@ class Merger:
         self._temp_dir.rmdir()
 
 
+class BatchMerger:
+    """
+    Слияние нескольких расширений в одну выгрузку основной конфигурации с общими настройками объединения.
+    Расширения объединяются в порядке имен, расширение с ошибкой откатывается и исключается из пакета.
+    Группы расширений, не изменяющих общие файлы, могут объединяться параллельно.
+    """
+
+    def __init__(self, cf_xml_path: pathlib.Path,
+                 cfe_xml_paths: Iterable[pathlib.Path],
+                 temp_dir: pathlib.Path,
+                 streaming: bool = False,
+                 memory_limit: int = 0,
+                 parallel: int = 1,
+                 groups: Optional[List[List[pathlib.Path]]] = None):
+        """
+        :param parallel: количество процессов для параллельного слияния групп
+        :param groups: группы независимых расширений, см. conflicts.ConflictIndex.groups
+        """
+
+        self._cf_xml_path = cf_xml_path
+        self._cfe_xml_paths = sorted(cfe_xml_paths, key=lambda p: p.name)
+        self._temp_dir = temp_dir
+
+        self.merge_settings = temp_dir.joinpath('batch_merge_settings.xml').resolve().absolute()
+        self.object_list = temp_dir.joinpath('batch_object_list.xml').resolve().absolute()
+        self.list_files = temp_dir.joinpath('batch_changed_files.lst').resolve().absolute()
+
+        self._objects: Dict[Optional[str], bool] = {}
+        self._files: Dict[str, None] = {}
+
+        self.merged: List[pathlib.Path] = []
+        self.failed: List[pathlib.Path] = []
+
+        self.streaming = streaming
+        self.memory_limit = memory_limit
+
+        self.parallel = parallel
+        self.groups = groups
+
+        self.version = '1.2'
+        self.platform_version = '8.3.11'
+
+    def merge(self) -> (pathlib.Path, pathlib.Path, pathlib.Path):
+
+        if self.parallel > 1 and self.groups and len(self.groups) > 1:
+            self.merge_groups()
+        else:
+            self.merge_extensions()
+
+        self.generate_settings()
+        return self.merge_settings, self.object_list, self.list_files
+
+    def merge_groups(self):
+        logger.info('Параллельное слияние %s групп расширений', len(self.groups), extra={'stage': 'merge'})
+        args = [(self._cf_xml_path, group, self._temp_dir, self.streaming, self.memory_limit)
+                for group in self.groups]
+        with Pool(min(self.parallel, len(self.groups)), initializer=log.configure_worker,
+                  initargs=(log.get_worker_queue(), logging.getLogger().level)) as pool:
+            results = pool.starmap(merge_group, args)
+
+        for merged, failed, objects, files in results:
+            self.merged.extend(merged)
+            self.failed.extend(failed)
+            self.add_records(objects, files)
+
+    def merge_extensions(self):
+
+        for cfe_xml_path in self._cfe_xml_paths:
+            logger.info('Начало слияния расширения %s в пакете', cfe_xml_path.stem,
+                        extra={'extension': cfe_xml_path.stem, 'stage': 'merge'})
+            merger = Merger(self._cf_xml_path, cfe_xml_path, self._temp_dir, self.streaming, self.memory_limit)
+            try:
+                merger.merge()
+            except Exception as ex:
+                logger.error('При слиянии расширения %s произошла ошибка %r, расширение будет исключено из пакета',
+                             cfe_xml_path.stem, ex, extra={'extension': cfe_xml_path.stem, 'stage': 'merge'})
+                merger.rollback()
+                self.failed.append(cfe_xml_path)
+                continue
+            finally:
+                merger.clear_temp()
+
+            self.add_records(merger.objects, merger.files)
+            self.merged.append(cfe_xml_path)
+
+    @property
+    def objects(self) -> List[ObjectRecord]:
+        return [ObjectRecord(full_name, is_new) for full_name, is_new in self._objects.items()]
+
+    @property
+    def files(self) -> List[str]:
+        return list(self._files)
+
+    def add_records(self, objects: Iterable[ObjectRecord], files: Iterable[str]):
+        """
+        Добавляет объекты и файлы расширения в общие настройки.
+        Объект считается новым, если его добавило хотя бы одно из расширений.
+        :param objects:
+        :param files:
+        :return:
+        """
+        for record in objects:
+            self._objects[record.full_name] = self._objects.get(record.full_name, False) or record.is_new
+        for file_name in files:
+            self._files[file_name] = None
+
+    def generate_settings(self):
+        records = self.objects
+        write_merge_settings(records, self.merge_settings, self.version, self.platform_version)
+        write_object_list(records, self.object_list)
+        write_list_files(self._files, self.list_files, self._cf_xml_path)
+
+
+def merge_group(cf_xml_path: pathlib.Path, cfe_xml_paths: List[pathlib.Path], temp_dir: pathlib.Path,
+                streaming: bool, memory_limit: int):
+    """
+    Последовательное слияние группы расширений в отдельном процессе
+    :return: объединенные и исключенные расширения, объекты и файлы для общих настроек
+    """
+    merger = BatchMerger(cf_xml_path, cfe_xml_paths, temp_dir, streaming, memory_limit)
+    merger.merge_extensions()
+    return merger.merged, merger.failed, merger.objects, merger.files
+
+
 def get_obj_module(obj: mdclasses.ConfObject):
     obj.read_modules()
     obj_modules = obj.modules
@@ -367,6 +526,128 @@ def get_obj_module(obj: mdclasses.ConfObject):
     return obj_modules
 
 
+def write_merge_settings(records: Iterable[ObjectRecord], merge_settings: pathlib.Path,
+                         version: str, platform_version: str):
+    element = etree.Element(
+        'Settings',
+        attrib={
+            "version": version,
+            "platformVersion": str(platform_version)
+        },
+        nsmap={
+            None: "http://v8.1c.ru/8.3/config/merge/settings",
+            "xs": "http://www.w3.org/2001/XMLSchema",
+            "xsi": "http://www.w3.org/2001/XMLSchema-instance",
+        }
+    )
+    e_params = etree.Element('Parameters')
+
+    e_param = etree.Element('ConfigurationsRelation')
+    e_param.text = 'SecondConfigurationIsDescendantOfMainConfiguration'
+    e_params.append(e_param)
+
+    e_param = etree.Element('AllowMainConfigurationObjectDeletion')
+    e_param.text = 'true'
+    e_params.append(e_param)
+
+    e_param = etree.Element('CopyObjectsMode')
+    e_param.text = 'false'
+    e_params.append(e_param)
+
+    element.append(e_params)
+
+    e_objects = etree.Element('Objects')
+
+    for obj in records:
+        if obj.full_name is None:
+            continue
+        attr_name = 'fullName'
+        if obj.is_new:
+            attr_name = 'fullNameInSecondConfiguration'
+        object = etree.Element(
+            'Object',
+            attrib={
+                attr_name: obj.full_name
+            }
+        )
+        merge_rule = etree.Element('MergeRule')
+        merge_rule.text = 'GetFromSecondConfiguration'
+        object.append(
+            merge_rule
+        )
+        e_objects.append(object)
+
+    element.append(e_objects)
+    merge_settings.write_bytes(
+        etree.tostring(element, xml_declaration=True, encoding='utf-8')
+    )
+
+
+def write_object_list(records: Iterable[ObjectRecord], object_list: pathlib.Path):
+    element = etree.Element(
+        'Objects',
+        attrib={
+            "version": '1.0',
+        },
+        nsmap={
+            None: "http://v8.1c.ru/8.3/config/objects"
+        }
+    )
+    conf_add = False
+    for obj in records:
+        if obj.full_name is None:
+            if conf_add:
+                continue
+            conf_add = True
+            xml_object = etree.Element(
+                'Configuration',
+                attrib={
+                   'includeChildObjects': 'false'
+                }
+            )
+        else:
+            xml_object = etree.Element('Object',
+                attrib={
+                    'fullName': obj.full_name,
+                    'includeChildObjects': 'true'}
+            )
+        element.append(xml_object)
+
+    object_list.write_bytes(
+        etree.tostring(element, xml_declaration=False, encoding='utf-8')
+    )
+
+
+def write_list_files(files: Iterable[str], list_files: pathlib.Path, xml_root: pathlib.Path):
+    """
+    Записывает список измененных файлов относительно каталога выгрузки,
+    чтобы список можно было использовать на другой машине вместе с выгрузкой
+    :param files:
+    :param list_files:
+    :param xml_root: каталог xml выгрузки основной конфигурации
+    :return:
+    """
+    xml_root = pathlib.Path(xml_root).absolute().resolve()
+    lines = []
+    for file_name in dict.fromkeys(files):
+        path = pathlib.Path(file_name).absolute().resolve()
+        try:
+            lines.append(path.relative_to(xml_root).as_posix())
+        except ValueError:
+            raise MergeError(f'Измененный файл {path} находится вне каталога выгрузки {xml_root}')
+    list_files.write_text('\n'.join(lines), encoding='utf-8')
+
+
+def release_obj_modules(obj: mdclasses.ConfObject):
+    """
+    Освобождает прочитанные модули и формы объекта
+    :param obj:
+    :return:
+    """
+    obj.modules = []
+    obj.forms = []
+
+
 def add_object_to_conf(main_conf: mdclasses.Configuration, obj: mdclasses.ConfObject) -> list:
     """
     Модификация файла Configuration.xml
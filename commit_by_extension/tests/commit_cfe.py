@@ -1,10 +1,14 @@
 import unittest
-from commit_by_extension import config, commit, utils, merging
+from commit_by_extension import config, commit, utils, merging, journal, conflicts, log
 import mdclasses
 from pathlib import Path
 from designer_cmd import api
 import shutil
 import logging
+import argparse
+import configparser
+from unittest import mock
+import commit_extemsion
 
 logging.basicConfig(level=logging.DEBUG)
 logging.root.addHandler(logging.StreamHandler())
@@ -106,6 +110,151 @@ class TestMerging(unittest.TestCase):
                          module_path.read_text(self.encoding),
                          'Данные перенесены не верно')
 
+    def test_merge_streaming(self):
+
+        merger = merging.Merger(self.tmp_cf_xml, self.cfe_xml, self.temp_dir, streaming=True)
+        merger.merge()
+        module_path = self.tmp_cf_xml.joinpath('Catalogs', 'Справочник1', 'Ext', 'ManagerModule.bsl')
+        example_module = self.xml_data_path.joinpath('ExampleMergeModule.bsl')
+
+        self.assertEqual(example_module.read_text(self.encoding),
+                         module_path.read_text(self.encoding),
+                         'Данные перенесены не верно')
+        self.assertIn('Catalog.Справочник1', merger.object_list.read_text('utf-8'),
+                      'Объект не отражен в списке объектов')
+        obj = merger._main_conf.get_object('Справочник1', mdclasses.ObjectType.CATALOG)
+        self.assertEqual(obj.modules, [], 'Модули объекта не освобождены')
+
+    def test_merge_memory_limit(self):
+
+        merger = merging.Merger(self.tmp_cf_xml, self.cfe_xml, self.temp_dir, streaming=True, memory_limit=1)
+        if utils.get_memory_usage() is None:
+            self.skipTest('Не удалось определить потребление памяти')
+        with self.assertRaises(merging.MergeError):
+            merger.merge()
+
+    def test_memory_limit_without_streaming(self):
+
+        with self.assertRaises(ValueError):
+            merging.Merger(self.tmp_cf_xml, self.cfe_xml, self.temp_dir, memory_limit=1)
+
+    def test_batch_merge(self):
+
+        merger = merging.BatchMerger(self.tmp_cf_xml, [self.cfe_xml], self.temp_dir)
+        merge_settings, object_list, list_files = merger.merge()
+        module_path = self.tmp_cf_xml.joinpath('Catalogs', 'Справочник1', 'Ext', 'ManagerModule.bsl')
+        example_module = self.xml_data_path.joinpath('ExampleMergeModule.bsl')
+
+        self.assertEqual(merger.merged, [self.cfe_xml], 'Расширение не объединено')
+        self.assertEqual(example_module.read_text(self.encoding),
+                         module_path.read_text(self.encoding),
+                         'Данные перенесены не верно')
+        self.assertTrue(merge_settings.exists(), 'Не сформированы настройки объединения')
+        self.assertIn('Catalog.Справочник1', object_list.read_text('utf-8'),
+                      'Объект не отражен в списке объектов')
+
+    def test_batch_merge_failed_extension(self):
+
+        broken_ext = self.xml_data_path.joinpath('tmp_extensions', 'broken_ext')
+        shutil.copytree(self.cfe_xml, broken_ext)
+        # Новый объект и расширение отсутствующей в основной конфигурации подпрограммы
+        catalogs = broken_ext.joinpath('Catalogs')
+        catalogs.joinpath('Справочник9.xml').write_text(
+            catalogs.joinpath('Справочник1.xml').read_text('utf-8-sig').replace('Справочник1', 'Справочник9'),
+            encoding='utf-8-sig')
+        description = broken_ext.joinpath('Configuration.xml')
+        description.write_text(description.read_text('utf-8-sig').replace(
+            '<Catalog>Справочник1</Catalog>', '<Catalog>Справочник1</Catalog>\n\t\t\t<Catalog>Справочник9</Catalog>'),
+            encoding='utf-8-sig')
+        object_module = catalogs.joinpath('Справочник1', 'Ext', 'ObjectModule.bsl')
+        object_module.write_text(object_module.read_text('utf-8-sig').replace(
+            '&После("Тестирование")', '&После("НеСуществующаяПроцедура")'), encoding='utf-8-sig')
+
+        main_description = self.tmp_cf_xml.joinpath('Configuration.xml').read_text(self.encoding)
+        try:
+            merger = merging.BatchMerger(self.tmp_cf_xml, [self.cfe_xml, broken_ext], self.temp_dir)
+            merge_settings, object_list, list_files = merger.merge()
+        finally:
+            utils.clear_folder(broken_ext.parent)
+            broken_ext.parent.rmdir()
+
+        self.assertEqual(merger.failed, [broken_ext], 'Расширение с ошибкой не исключено')
+        self.assertEqual(merger.merged, [self.cfe_xml], 'Расширение без ошибок не объединено')
+
+        module_path = self.tmp_cf_xml.joinpath('Catalogs', 'Справочник1', 'Ext', 'ManagerModule.bsl')
+        example_module = self.xml_data_path.joinpath('ExampleMergeModule.bsl')
+        self.assertEqual(example_module.read_text(self.encoding),
+                         module_path.read_text(self.encoding),
+                         'Изменения расширения с ошибкой не отменены')
+        object_module_text = self.tmp_cf_xml.joinpath('Catalogs', 'Справочник1', 'Ext', 'ObjectModule.bsl')\
+            .read_text(self.encoding)
+        self.assertNotIn('broken_ext', object_module_text, 'Изменения расширения с ошибкой не отменены')
+        self.assertFalse(self.tmp_cf_xml.joinpath('Catalogs', 'Справочник9.xml').exists(),
+                         'Не удален новый объект расширения с ошибкой')
+        self.assertEqual(main_description, self.tmp_cf_xml.joinpath('Configuration.xml').read_text(self.encoding),
+                         'Не восстановлено описание конфигурации')
+
+        object_list_text = object_list.read_text('utf-8')
+        self.assertIn('Catalog.Справочник1', object_list_text)
+        self.assertNotIn('Справочник9', object_list_text, 'Объект расширения с ошибкой попал в список объектов')
+
+    def test_rollback(self):
+
+        module_path = self.tmp_cf_xml.joinpath('Catalogs', 'Справочник1', 'Ext', 'ManagerModule.bsl')
+        module_text = module_path.read_text(self.encoding)
+
+        merger = merging.Merger(self.tmp_cf_xml, self.cfe_xml, self.temp_dir)
+        merger.merge()
+        merger.rollback()
+
+        self.assertEqual(module_text, module_path.read_text(self.encoding), 'Изменения не отменены')
+
+    def test_merge_command(self):
+
+        output = self.temp_dir.joinpath('output').absolute()
+        args = argparse.Namespace(cf_xml=str(self.cf_xml), cfe_xml=str(self.cfe_xml), output=str(output),
+                                  streaming=False, memory_limit=0)
+        commit_extemsion.merge_xml(args)
+
+        module_path = output.joinpath('xml', 'Catalogs', 'Справочник1', 'Ext', 'ManagerModule.bsl')
+        example_module = self.xml_data_path.joinpath('ExampleMergeModule.bsl')
+
+        self.assertEqual(example_module.read_text(self.encoding),
+                         module_path.read_text(self.encoding),
+                         'Данные перенесены не верно')
+        self.assertTrue(output.joinpath(f'{self.cfe_xml.stem}_merge_settings.xml').exists(),
+                        'Не сформированы настройки объединения')
+
+        changed_files = output.joinpath(f'{self.cfe_xml.stem}_changed_files.lst').read_text('utf-8').splitlines()
+        self.assertIn('Catalogs/Справочник1/Ext/ManagerModule.bsl', changed_files)
+        for file_name in changed_files:
+            self.assertFalse(Path(file_name).is_absolute(), f'Путь {file_name} в списке файлов не относительный')
+            self.assertTrue(output.joinpath('xml', file_name).exists(),
+                            f'Файл {file_name} из списка файлов отсутствует в выгрузке')
+
+    def test_merge_command_extension_dir_named_xml(self):
+
+        cfe_xml = self.temp_dir.joinpath('extension', 'xml').absolute()
+        shutil.copytree(self.cfe_xml, cfe_xml)
+        output = self.temp_dir.joinpath('output').absolute()
+        args = argparse.Namespace(cf_xml=str(self.cf_xml), cfe_xml=str(cfe_xml), output=str(output),
+                                  streaming=False, memory_limit=0)
+        commit_extemsion.merge_xml(args)
+
+        module_path = output.joinpath('xml', 'Catalogs', 'Справочник1', 'Ext', 'ManagerModule.bsl')
+        self.assertEqual(self.xml_data_path.joinpath('ExampleMergeModule.bsl').read_text(self.encoding),
+                         module_path.read_text(self.encoding),
+                         'Результат слияния удален вместе с временным каталогом')
+
+    def test_merge_command_memory_limit_without_streaming(self):
+
+        output = self.temp_dir.joinpath('output').absolute()
+        args = argparse.Namespace(cf_xml=str(self.cf_xml), cfe_xml=str(self.cfe_xml), output=str(output),
+                                  streaming=False, memory_limit=100)
+        with self.assertRaises(ValueError):
+            commit_extemsion.merge_xml(args)
+        self.assertFalse(output.joinpath('xml').exists(), 'Выгрузка скопирована при неверных параметрах')
+
     def test_add_module(self):
 
         merger = merging.Merger(self.tmp_cf_xml, self.cfe_xml, self.temp_dir)
@@ -131,5 +280,316 @@ class TestMerging(unittest.TestCase):
         self.temp_dir.rmdir()
 
 
+class TestConflicts(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.cf_xml = Path('test_data/xml_data/main_xml').absolute().resolve()
+        self.cfe_xml = Path('test_data/xml_data/extension_xml').absolute().resolve()
+
+    def test_index(self):
+        index = conflicts.build_index(self.cf_xml, [self.cfe_xml])
+        module_name = str(Path('Catalogs', 'Справочник1', 'Ext', 'ManagerModule.bsl'))
+
+        hooks = index.hooks[('Catalog.Справочник1', module_name, 'Тестирование'.upper())]
+        self.assertEqual([hook.extension for hook in hooks], [self.cfe_xml.stem])
+        self.assertEqual(index.conflicts(), [], 'Обнаружен ложный конфликт')
+        self.assertEqual(index.groups(), [[self.cfe_xml.stem]])
+
+    def test_same_object_group(self):
+        tmp_dir = Path('test_data/xml_data/tmp_extensions').absolute().resolve()
+        module_dir = Path('Catalogs', 'Справочник1', 'Ext')
+        manager_ext = tmp_dir.joinpath('manager_ext')
+        object_ext = tmp_dir.joinpath('object_ext')
+        shutil.copytree(self.cfe_xml, manager_ext)
+        shutil.copytree(self.cfe_xml, object_ext)
+        manager_ext.joinpath(module_dir, 'ObjectModule.bsl').unlink()
+        object_ext.joinpath(module_dir, 'ManagerModule.bsl').unlink()
+        try:
+            index = conflicts.build_index(self.cf_xml, [manager_ext, object_ext])
+            self.assertEqual(index.groups(), [['manager_ext', 'object_ext']],
+                             'Расширения, изменяющие разные модули одного объекта, попали в разные группы')
+        finally:
+            utils.clear_folder(tmp_dir)
+            tmp_dir.rmdir()
+
+    def test_replace_conflict(self):
+        index = conflicts.ConflictIndex(self.cf_xml)
+        key = ('Catalog.Справочник1', 'Module.bsl', 'ТЕСТИРОВАНИЕ')
+        index.hooks[key] = [conflicts.Hook('first', 'Вместо'), conflicts.Hook('second', 'После')]
+        index.resources = {'first': {'Module.bsl'}, 'second': {'Module.bsl'}, 'third': {'Other.bsl'}}
+
+        found = index.conflicts()
+        self.assertEqual(len(found), 1)
+        self.assertEqual(conflicts.excluded_extensions(found), {'second'})
+        self.assertEqual(index.groups(), [['first', 'second'], ['third']])
+
+    def test_change_and_control_conflict(self):
+        index = conflicts.ConflictIndex(self.cf_xml)
+        index.hooks[('Catalog.Справочник1', 'Module.bsl', 'ТЕСТИРОВАНИЕ')] = [
+            conflicts.Hook('first', 'ИзменениеИКонтроль'), conflicts.Hook('second', 'ИзменениеИКонтроль')]
+        index.hooks[('Catalog.Справочник1', 'Module.bsl', 'ЗАПИСЬ')] = [
+            conflicts.Hook('first', 'Перед'), conflicts.Hook('second', 'После')]
+
+        found = index.conflicts()
+        self.assertEqual([conflict.sub_program for conflict in found], ['ТЕСТИРОВАНИЕ'])
+        self.assertEqual(conflicts.excluded_extensions(found), {'second'})
+
+
+class FakeDesigner:
+    """
+    Конфигуратор без платформы: выгрузки берутся из test_data/xml_data, вызовы сохраняются в calls
+    """
+    calls = []
+    fail_on_commit = None
+    fail_on_convert = None
+
+    def __init__(self, *args, **kwargs):
+        self.extensions = []
+
+    def update_conf_from_repo(self):
+        self.calls.append('update_conf_from_repo')
+
+    def dump_config_to_files(self, path):
+        self.calls.append('dump_config_to_files')
+        utils.clear_folder(path)
+        shutil.copytree(Path('test_data/xml_data/main_xml'), path, dirs_exist_ok=True)
+
+    def load_extension_from_file(self, path, name):
+        self.extensions.append(name)
+
+    def dump_extensions_to_files(self, path):
+        self.calls.append('dump_extensions_to_files')
+        for name in self.extensions:
+            shutil.copytree(Path('test_data/xml_data/extension_xml'), Path(path).joinpath(name), dirs_exist_ok=True)
+
+    def manage_support(self):
+        pass
+
+    def load_config_from_files(self, path, list_files):
+        if self.fail_on_convert is not None and Path(list_files).name.startswith(self.fail_on_convert):
+            raise RuntimeError('Аварийное завершение')
+        self.calls.append('load_config_from_files')
+
+    def dump_config_to_file(self, cf_path):
+        Path(cf_path).write_text(cf_path, encoding='utf-8')
+
+    def lock_objects_in_repository(self, object_list):
+        pass
+
+    def merge_config_with_file(self, cf_path, merge_settings):
+        pass
+
+    def commit_config_to_repo(self, comment, object_list):
+        if comment == self.fail_on_commit:
+            raise RuntimeError('Аварийное завершение')
+        self.calls.append(comment)
+
+    def unlock_objects_in_repository(self, object_list):
+        pass
+
+
+class FakeProcess:
+    exitcode = 0
+
+    def join(self):
+        pass
+
+
+def start_process_in_place(target, *args):
+    target(*args)
+    return FakeProcess()
+
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = Path('test_data/temp').absolute().resolve()
+        extension_dir = self.temp_dir.joinpath('extensions')
+        extension_dir.mkdir()
+        for name in ('first', 'second'):
+            extension_dir.joinpath(f'{name}.cfe').write_text(name, encoding='utf-8')
+
+        parser = configparser.ConfigParser()
+        parser.read_dict({
+            '1c': {'version': '8.3.18.1128'},
+            'path': {'extension_dir': str(extension_dir), 'temp_dir': str(self.temp_dir.joinpath('work')),
+                     'base_xml': str(self.temp_dir.joinpath('main_xml'))},
+            'base': {'user': '', 'password': '', 'path': 'base', 'server': '', 'ref': ''},
+            'repo': {'path': 'repo', 'user': '', 'password': ''},
+        })
+        self.config = config.Config(parser)
+
+        patches = [
+            mock.patch.object(commit.api, 'Designer', FakeDesigner),
+            mock.patch.object(commit.api, 'Connection', mock.MagicMock()),
+            mock.patch.object(commit.api, 'RepositoryConnection', mock.MagicMock()),
+            mock.patch.object(commit, 'start_process', start_process_in_place),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_resume_after_commit(self):
+        FakeDesigner.calls = []
+        FakeDesigner.fail_on_commit = 'Слияние c расширением second.cf'
+        with self.assertRaises(RuntimeError):
+            commit.main(self.config)
+        self.assertIn('Слияние c расширением first.cf', FakeDesigner.calls)
+
+        FakeDesigner.calls = []
+        FakeDesigner.fail_on_commit = None
+        commit.main(self.config, resume=True)
+
+        self.assertEqual(FakeDesigner.calls, ['Слияние c расширением second.cf'],
+                         'При продолжении повторно выполнены завершенные этапы')
+
+    def test_resume_rebuilds_changed_workspace(self):
+        FakeDesigner.calls = []
+        FakeDesigner.fail_on_commit = 'Слияние c расширением second.cf'
+        with self.assertRaises(RuntimeError):
+            commit.main(self.config)
+
+        self.config.base_xml.joinpath('Configuration.xml').write_text('changed', encoding='utf-8')
+        FakeDesigner.calls = []
+        FakeDesigner.fail_on_commit = None
+        commit.main(self.config, resume=True)
+
+        self.assertIn('update_conf_from_repo', FakeDesigner.calls, 'Измененная выгрузка не обновлена из хранилища')
+        self.assertIn('load_config_from_files', FakeDesigner.calls, 'Слияние не выполнено повторно')
+        self.assertNotIn('Слияние c расширением first.cf', FakeDesigner.calls,
+                         'Повторно помещено уже помещенное в хранилище расширение')
+
+    def test_resume_after_unrecorded_commit(self):
+        FakeDesigner.calls = []
+        FakeDesigner.fail_on_convert = 'second'
+        try:
+            # Основной процесс завершается до записи в журнал помещения первого расширения
+            with self.assertRaises(RuntimeError):
+                commit.main(self.config)
+        finally:
+            FakeDesigner.fail_on_convert = None
+        self.assertIn('Слияние c расширением first.cf', FakeDesigner.calls)
+
+        FakeDesigner.calls = []
+        commit.main(self.config, resume=True)
+
+        self.assertEqual([call for call in FakeDesigner.calls if call.startswith('Слияние')],
+                         ['Слияние c расширением second.cf'], 'Повторно помещено уже помещенное в хранилище расширение')
+
+    def test_resume_changed_extension(self):
+        FakeDesigner.calls = []
+        FakeDesigner.fail_on_commit = 'Слияние c расширением second.cf'
+        with self.assertRaises(RuntimeError):
+            commit.main(self.config)
+
+        self.config.extension_dir.joinpath('second.cfe').write_text('second changed', encoding='utf-8')
+        FakeDesigner.calls = []
+        FakeDesigner.fail_on_commit = None
+        commit.main(self.config, resume=True)
+
+        self.assertIn('update_conf_from_repo', FakeDesigner.calls,
+                      'Выгрузка с прежним слиянием расширения не обновлена из хранилища')
+        self.assertEqual([call for call in FakeDesigner.calls if call.startswith('Слияние')],
+                         ['Слияние c расширением second.cf'])
+        self.assert_merged_once('second')
+
+    def test_resume_batch_changed_extension(self):
+        self.config.merge_batch = True
+        FakeDesigner.calls = []
+        FakeDesigner.fail_on_commit = 'Слияние c расширениями first, second'
+        with self.assertRaises(RuntimeError):
+            commit.main(self.config)
+
+        self.config.extension_dir.joinpath('second.cfe').write_text('second changed', encoding='utf-8')
+        FakeDesigner.calls = []
+        FakeDesigner.fail_on_commit = None
+        commit.main(self.config, resume=True)
+
+        self.assertIn('update_conf_from_repo', FakeDesigner.calls,
+                      'Выгрузка с прежним пакетным слиянием не обновлена из хранилища')
+        self.assertIn('Слияние c расширениями first, second', FakeDesigner.calls)
+        self.assert_merged_once('first')
+        self.assert_merged_once('second')
+
+    def assert_merged_once(self, name: str):
+        for module_path in self.config.base_xml.rglob('*.bsl'):
+            text = module_path.read_text(encoding='utf-8-sig')
+            self.assertLessEqual(text.count(f'#Область ИмпортИзРасширения_{name}'), 1,
+                                 f'Расширение {name} повторно объединено с модулем {module_path}')
+            self.assertNotIn('changed_changed_', text, f'Расширение {name} повторно объединено с модулем {module_path}')
+
+    def tearDown(self) -> None:
+        utils.clear_folder(self.temp_dir)
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = Path('test_data/temp').absolute().resolve()
+        self.journal_path = self.temp_dir.joinpath('journal.json')
+        self.artifact = self.temp_dir.joinpath('artifact.xml')
+        self.artifact.write_text('data', encoding='utf-8')
+
+    def test_resume(self):
+        stages = journal.Journal(self.journal_path)
+        stages.mark_done('ext:merge', self.artifact, data='ext')
+
+        resumed = journal.Journal(self.journal_path, resume=True)
+        self.assertTrue(resumed.is_done('ext:merge', self.artifact), 'Выполненный этап не восстановлен')
+        self.assertEqual(resumed.get_data('ext:merge'), 'ext')
+        self.assertFalse(journal.Journal(self.journal_path).is_done('ext:merge', self.artifact),
+                         'Без resume этапы не должны пропускаться')
+
+    def test_changed_artifact(self):
+        journal.Journal(self.journal_path).mark_done('ext:merge', self.artifact)
+        self.artifact.write_text('changed', encoding='utf-8')
+
+        resumed = journal.Journal(self.journal_path, resume=True)
+        self.assertFalse(resumed.is_done('ext:merge', self.artifact), 'Не обнаружено изменение результата этапа')
+
+    def test_marker(self):
+        marker = self.temp_dir.joinpath('ext.committed')
+        journal.write_marker(marker, self.artifact)
+        self.assertTrue(journal.has_marker(marker, self.artifact), 'Отметка этапа не обнаружена')
+
+        self.artifact.write_text('changed', encoding='utf-8')
+        self.assertFalse(journal.has_marker(marker, self.artifact), 'Не обнаружено изменение результата этапа')
+
+    def test_corrupted_journal(self):
+        journal.Journal(self.journal_path).mark_done('ext:merge', self.artifact)
+        self.journal_path.write_text(
+            self.journal_path.read_text(encoding='utf-8').replace('ext:merge', 'ext:cf'), encoding='utf-8')
+
+        resumed = journal.Journal(self.journal_path, resume=True)
+        self.assertFalse(resumed.is_done('ext:cf', self.artifact), 'Не обнаружено повреждение журнала')
+
+    def tearDown(self) -> None:
+        utils.clear_folder(self.temp_dir)
+
+
+class TestLogging(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = Path('test_data/temp').absolute().resolve()
+        self.log_path = self.temp_dir.joinpath('working.log')
+
+    def test_structured_fields(self):
+        log.setup_logging(str(self.log_path))
+        try:
+            adapter = log.ContextAdapter(logging.getLogger(__name__), {'extension': 'module', 'stage': 'merge'})
+            adapter.info('Слияние объекта %s', 'Catalog.Справочник1', extra={'object': 'Catalog.Справочник1'})
+            logging.getLogger(__name__).debug('Не попадает в журнал %s', 1)
+        finally:
+            log.stop_logging()
+            logging.basicConfig(level=logging.DEBUG)
+
+        text = self.log_path.read_text(encoding='utf-8')
+        self.assertIn('|module|Catalog.Справочник1|-|merge|Слияние объекта Catalog.Справочник1', text)
+        self.assertNotIn('Не попадает в журнал', text)
+
+    def tearDown(self) -> None:
+        utils.clear_folder(self.temp_dir)
+
+
 if __name__ == '__main__':
     unittest.main()
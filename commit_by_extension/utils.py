@@ -1,7 +1,8 @@
 import shutil
 import os
+import sys
 import os.path as path
-from typing import Union
+from typing import Union, Optional
 import pathlib
 
 
@@ -15,4 +16,58 @@ def clear_folder(dir_path: Union[str, pathlib.Path]):
             if path.isdir(file_path):
                 shutil.rmtree(file_path)
             else:
-                os.remove(file_path)
\ No newline at end of file
+                os.remove(file_path)
+
+
+def get_memory_usage() -> Optional[int]:
+    """
+    Текущее потребление памяти процессом в МБ, None если определить не удалось.
+    Определяется на Windows и системах с /proc. Пиковое значение (ru_maxrss) не используется:
+    после превышения предела оно не уменьшается и все последующие проверки завершались бы ошибкой.
+    :return:
+    """
+    if sys.platform == 'win32':
+        return get_windows_memory_usage()
+    statm = pathlib.Path('/proc/self/statm')
+    if statm.exists():
+        resident_pages = int(statm.read_text().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') // (1024 * 1024)
+    return None
+
+
+def get_windows_memory_usage() -> Optional[int]:
+    """
+    Текущий рабочий набор процесса в МБ через GetProcessMemoryInfo, None если определить не удалось
+    :return:
+    """
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [
+            ('cb', wintypes.DWORD),
+            ('PageFaultCount', wintypes.DWORD),
+            ('PeakWorkingSetSize', ctypes.c_size_t),
+            ('WorkingSetSize', ctypes.c_size_t),
+            ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+            ('PagefileUsage', ctypes.c_size_t),
+            ('PeakPagefileUsage', ctypes.c_size_t),
+        ]
+
+    try:
+        get_current_process = ctypes.windll.kernel32.GetCurrentProcess
+        get_current_process.restype = wintypes.HANDLE
+        get_process_memory_info = ctypes.windll.psapi.GetProcessMemoryInfo
+        get_process_memory_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+        get_process_memory_info.restype = wintypes.BOOL
+    except (AttributeError, OSError):
+        return None
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    if not get_process_memory_info(get_current_process(), ctypes.byref(counters), counters.cb):
+        return None
+    return counters.WorkingSetSize // (1024 * 1024)
@@ -1,7 +1,5 @@
 import argparse
 import pathlib
-from commit_by_extension.commit import main
-from commit_by_extension.config import get_config
 
 
 def parse():
@@ -12,20 +10,91 @@ def parse():
 def parse_args():
 
     parser = argparse.ArgumentParser(prog='commit_extemsion.py')
-    parser.add_argument('--config', '-c',  required=True, type=str, help='Путь к настройкам')
+    parser.add_argument('--config', '-c', type=str, help='Путь к настройкам')
+    parser.add_argument('--resume', action='store_true',
+                        help='Продолжить прерванную обработку, пропуская выполненные этапы')
 
     parser.set_defaults(func=commit_extensions)
 
+    subparsers = parser.add_subparsers(title='Команды')
+
+    merge_parser = subparsers.add_parser(
+        'merge', help='Слияние xml выгрузок конфигурации и расширения без использования платформы')
+    merge_parser.add_argument('cf_xml', type=str, help='Каталог xml выгрузки основной конфигурации')
+    merge_parser.add_argument('cfe_xml', type=str, help='Каталог xml выгрузки расширения')
+    merge_parser.add_argument('output', type=str, help='Каталог для результата слияния')
+    merge_parser.add_argument('--streaming', action='store_true',
+                              help='Освобождать модули объектов сразу после обработки')
+    merge_parser.add_argument('--memory-limit', type=int, default=0,
+                              help='Предел потребляемой памяти в МБ, только вместе с --streaming')
+    merge_parser.set_defaults(func=merge_xml)
+
     return parser.parse_args()
 
 
 def commit_extensions(args):
+    # Импорт выполняется здесь, т.к. модуль commit требует платформу и настраивает журнал работы
+    from commit_by_extension.commit import main
+    from commit_by_extension.config import get_config
+    from commit_by_extension import log
+
+    if args.config is None:
+        raise ValueError('Не указан путь к настройкам --config')
+
     config_file = pathlib.Path(args.config)
     if not config_file.exists():
         raise FileNotFoundError(f'Не обнаружен файл настроек по пути {config_file}')
 
-    main(get_config(config_file))
+    config = get_config(config_file)
+    log.setup_logging(config.log_file, config.log_level, config.log_format)
+    try:
+        main(config, args.resume)
+    finally:
+        log.stop_logging()
+
+
+def merge_xml(args):
+    import logging
+    import shutil
+    import tempfile
+    from commit_by_extension.merging import Merger, MergeError
+    from commit_by_extension import log
+
+    if args.memory_limit and not args.streaming:
+        raise ValueError('Параметр --memory-limit задается только вместе с --streaming')
+
+    cf_xml_path = pathlib.Path(args.cf_xml).absolute().resolve()
+    cfe_xml_path = pathlib.Path(args.cfe_xml).absolute().resolve()
+    output_path = pathlib.Path(args.output).absolute().resolve()
+
+    for xml_path in (cf_xml_path, cfe_xml_path):
+        if not xml_path.is_dir():
+            raise FileNotFoundError(f'Не обнаружен каталог xml выгрузки по пути {xml_path}')
+
+    output_xml_path = output_path.joinpath('xml')
+    if output_xml_path.exists():
+        raise FileExistsError(f'Каталог результата слияния {output_xml_path} уже существует')
+    output_path.mkdir(parents=True, exist_ok=True)
+    shutil.copytree(cf_xml_path, output_xml_path, ignore=shutil.ignore_patterns('ConfigDumpInfo.xml'))
 
+    # Временный каталог слияния отделен от результата: его содержимое удаляется после слияния
+    temp_dir = pathlib.Path(tempfile.mkdtemp())
+    log.setup_logging()
+    try:
+        merger = Merger(output_xml_path, cfe_xml_path, temp_dir, args.streaming, args.memory_limit)
+        try:
+            merger.merge()
+        except MergeError as ex:
+            logging.getLogger(__name__).error('Ошибка слияния расширения %s: %s', cfe_xml_path.stem, ex,
+                                              extra={'extension': cfe_xml_path.stem, 'stage': 'merge'})
+            raise SystemExit(1)
+        finally:
+            merger.clear_temp()
+        for settings_path in (merger.merge_settings, merger.object_list, merger.list_files):
+            shutil.move(str(settings_path), str(output_path.joinpath(settings_path.name)))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        log.stop_logging()
 
 if __name__ == '__main__':
     parse()